@@ -20,8 +20,13 @@ Receive: [0xFF]
 
 """
 
-import statistics
+import atexit
+import json
+import logging
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime
 import numpy as np
@@ -36,6 +41,71 @@ from Phidget22.BridgeGain import BridgeGain
 from roboclaw_3 import Roboclaw
 from parse_calibration_curve import parse_calibration_curve
 
+log = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    """Preallocated buffer of loadcell values, filled by the bridge callback.
+
+    count is the total number of values pushed. Once more than size values are
+    pushed the oldest ones get overwritten, check overflowed() before relying
+    on all of them being there.
+    """
+
+    # push runs in the bridge callback for every value, slots keep the
+    # attribute lookups there cheap.
+    __slots__ = ("buf", "size", "count")
+
+    def __init__(self, size: int):
+        self.buf = np.empty(size)
+        self.size = size
+        self.count = 0
+
+    def push(self, value: float):
+        self.buf[self.count % self.size] = value
+        self.count += 1
+
+    def last(self) -> float:
+        """Latest value"""
+        return self.buf[(self.count - 1) % self.size]
+
+    def between(self, start: int, stop: int) -> np.ndarray:
+        """Values pushed while count went from start to stop, oldest first"""
+        start_i = start % self.size
+        stop_i = stop % self.size
+        if start_i < stop_i or start == stop:
+            return self.buf[start_i:stop_i]  # a view, no copy
+        return np.concatenate((self.buf[start_i:], self.buf[:stop_i]))
+
+    def overflowed(self) -> bool:
+        """True once the oldest values have been overwritten"""
+        return self.count > self.size
+
+    def values(self) -> np.ndarray:
+        """All values pushed, oldest first"""
+        if self.overflowed():
+            raise RuntimeError(
+                f"Ran out of space, {self.count - self.size} values overwritten"
+            )
+        return self.buf[: self.count]
+
+
+def find_motor_com() -> str:
+    """Return the serial port of the motor controller.
+
+    Set the MOTOR_COM environment variable to skip scanning the serial ports.
+    """
+    if motor_com := os.environ.get("MOTOR_COM"):
+        return motor_com
+    # The motor controller shows up as stm virtual com port.
+    # pick the first match.
+    # Case insensitive, like list_ports.grep
+    name = "STMicroelectronics Virtual COM Port".lower()
+    for port in serial.tools.list_ports.comports():
+        if name in (port.description or "").lower():
+            return port.device
+    raise RuntimeError("Motor controller not found, set MOTOR_COM to its port")
+
 
 def generate_calibration_curve(
     motor_com: str,
@@ -44,26 +114,39 @@ def generate_calibration_curve(
     loadcell_ref_scale: float,
     loadcell_ref_ch: int,
     loadcell_dut_ch: int,
-) -> tuple[list[float], list[float]]:
-    """Return the readings of both loadcells."""
+) -> tuple[np.ndarray, np.ndarray, float, float]:
+    """Return the readings of both loadcells, then the tare of each."""
     ## motor controller setup
-    print("setting up motor connection")
+    log.info("setting up motor connection")
     motor = Roboclaw(motor_com, motor_baud)
     motor.Open()
+    # Have the kernel pass on serial data as soon as it arrives instead of
+    # batching it, so motor commands respond with less delay. Only available
+    # on linux, and not every USB serial driver supports it.
+    # Relies on roboclaw_3.Roboclaw.Open setting _port to the pyserial port.
+    try:
+        motor._port.set_low_latency_mode(True)
+    except (AttributeError, NotImplementedError, ValueError) as e:
+        log.debug("motor serial port low latency mode not set: %s", e)
 
     ## Bridge adc setup
-    print("setting up bridge adc")
+    log.info("setting up bridge adc")
     ch_ref = VoltageRatioInput.VoltageRatioInput()
     ch_dut = VoltageRatioInput.VoltageRatioInput()
 
-    print("REF channel", loadcell_ref_ch)
-    print("DUT channel", loadcell_dut_ch)
+    log.info("REF channel %d", loadcell_ref_ch)
+    log.info("DUT channel %d", loadcell_dut_ch)
     ch_ref.setChannel(loadcell_ref_ch)
     ch_dut.setChannel(loadcell_dut_ch)
 
-    print("opening attachement to bridge")
-    ch_ref.openWaitForAttachment(1000)
-    ch_dut.openWaitForAttachment(1000)
+    log.info("opening attachement to bridge")
+    # Each wait can take up to the timeout, so wait for both at the same time.
+    with ThreadPoolExecutor() as executor:
+        attachments = [
+            executor.submit(ch.openWaitForAttachment, 1000) for ch in (ch_ref, ch_dut)
+        ]
+    for attachment in attachments:
+        attachment.result()  # raises if the channel did not attach
 
     # Setting the VoltageRatioChangeTrigger to 0 will result in the channel
     # firing events every DataInterval
@@ -74,13 +157,18 @@ def generate_calibration_curve(
     # different frequencies. Pick either 100ms or 50ms period for best results.
     # Anything lower is much worse.
     loadcell_sample_interval = 50  # ms
+    # Give up if there is no new value for this long, the bridge has stalled
+    # or been disconnected.
+    loadcell_wait_timeout = 20 * loadcell_sample_interval / 1000  # s
+    # The first values can take a second or so, allow a few times that.
+    loadcell_start_timeout = 5.0  # s
     ch_ref.setDataInterval(loadcell_sample_interval)
     ch_dut.setDataInterval(loadcell_sample_interval)
 
     # verify that the rate has been changed TODO progromatic
-    print("Loadcell rates")
-    print("REF:", ch_ref.getDataRate(), "Hz")
-    print("DUT:", ch_dut.getDataRate(), "Hz")
+    log.info("Loadcell rates")
+    log.info("REF: %s Hz", ch_ref.getDataRate())
+    log.info("DUT: %s Hz", ch_dut.getDataRate())
 
     # Use maximum gain, since testing is done at this gain
     ch_ref.setBridgeGain(BridgeGain.BRIDGE_GAIN_128)
@@ -91,42 +179,106 @@ def generate_calibration_curve(
 
     ## Tare both loadcells
     # Saving the data requires a callback function that processes the data.
-    # To stop the recording data set the call back to None.
     # It takes a second or so to start getting data after the callback is set.
-    loadcell_values = {loadcell_ref_ch: [], loadcell_dut_ch: []}
-
-    def save_bridge_value(vri, value):
-        loadcell_values[vri.getChannel()].append(value)
-
-    ch_ref.setOnVoltageRatioChangeHandler(save_bridge_value)
-    ch_dut.setOnVoltageRatioChangeHandler(save_bridge_value)
-
-    print("Getting values to tare loadcell")
+    # The callbacks stay set for the whole run. The first values of each
+    # channel go to the tare, the rest are recorded for the calibration curve,
+    # so no values are dropped in between.
+    # Values are written into ring buffers, so saving a value never has to grow
+    # or reallocate a list.
     tare_num_vals = 15
-    with tqdm(total=tare_num_vals, desc="Taring", unit="samples") as pbar:
-        while (num_vals := len(loadcell_values[loadcell_ref_ch])) < tare_num_vals:
+    ref_tare = RingBuffer(tare_num_vals)
+    dut_tare = RingBuffer(tare_num_vals)
+
+    # Sized for 10 minutes of recording, much longer than a run takes. The
+    # recording must never wrap around, the REF and DUT values would no longer
+    # line up, so the run is stopped if it goes on for longer.
+    record_max_time = 10 * 60  # s
+    record_num_vals = record_max_time * 1000 // loadcell_sample_interval
+    ref_buffer = RingBuffer(record_num_vals)
+    dut_buffer = RingBuffer(record_num_vals)
+
+    # The callback runs in the Phidget thread. Notify the main thread of every
+    # new value instead of having it poll on a timer, so it reacts to a sample
+    # as soon as it arrives.
+    new_value = threading.Condition()
+
+    def make_bridge_handler(tare: RingBuffer, buffer: RingBuffer):
+        """Callback that saves the values of one channel into tare, then buffer"""
+        # Each channel gets its own callback bound to its buffers, so there is
+        # no getChannel() call or dict lookup per value.
+        push_tare = tare.push
+        push = buffer.push
+
+        def save_bridge_value(_vri, value):
+            with new_value:
+                if tare.count < tare_num_vals:
+                    push_tare(value)
+                else:
+                    push(value)
+                new_value.notify_all()
+
+        return save_bridge_value
+
+    def wait_for_values(
+        buffer: RingBuffer, num_vals: int, timeout: float = loadcell_wait_timeout
+    ) -> int:
+        """Wait for more than num_vals values in buffer, return the count"""
+        with new_value:
+            got_values = new_value.wait_for(
+                lambda: buffer.count > num_vals, timeout=timeout
+            )
+            num_vals = buffer.count
+        if got_values and not buffer.overflowed():
+            return num_vals
+        # The load can't be watched anymore, don't leave the motor running.
+        motor.ForwardM1(motor_addr, 0)
+        if got_values:
+            raise RuntimeError(
+                f"Ran out of space, recording is limited to {buffer.size} values"
+            )
+        raise TimeoutError(f"No loadcell values for {timeout} s")
+
+    ch_ref.setOnVoltageRatioChangeHandler(make_bridge_handler(ref_tare, ref_buffer))
+    ch_dut.setOnVoltageRatioChangeHandler(make_bridge_handler(dut_tare, dut_buffer))
+
+    # Only redraw the progress bars every so often, terminal output in the
+    # control loops delays reacting to the next value.
+    pbar_interval = 0.25  # s
+
+    log.info("Getting values to tare loadcell")
+    with tqdm(
+        total=tare_num_vals, desc="Taring", unit="samples", mininterval=pbar_interval
+    ) as pbar:
+        while (num_vals := ref_tare.count) < tare_num_vals:
             pbar.update(num_vals - pbar.n)
-            time.sleep(loadcell_sample_interval / 1000)
+            wait_for_values(ref_tare, num_vals, loadcell_start_timeout)
         pbar.update(num_vals - pbar.n)
+    # The DUT channel is at most a value behind
+    while (num_vals := dut_tare.count) < tare_num_vals:
+        wait_for_values(dut_tare, num_vals, loadcell_start_timeout)
 
-    ch_ref.setOnVoltageRatioChangeHandler(None)
-    ch_dut.setOnVoltageRatioChangeHandler(None)
+    tare_ref = float(ref_tare.values().mean())
+    tare_dut = float(dut_tare.values().mean())
 
-    tare_ref = statistics.fmean(loadcell_values[loadcell_ref_ch])
-    tare_dut = statistics.fmean(loadcell_values[loadcell_dut_ch])
+    log.info("tare ref: %s len of sample %d", tare_ref, ref_tare.count)
+    log.info("tare dut: %s len of sample %d", tare_dut, dut_tare.count)
+    # The noise while nothing is touching the loadcells, to spot a bad tare.
+    log.info("tare ref std: %s", ref_tare.values().std())
+    log.info("tare dut std: %s", dut_tare.values().std())
 
-    print("tare ref:", tare_ref, "len of sample", len(loadcell_values[loadcell_ref_ch]))
-    print("tare dut:", tare_dut, "len of sample", len(loadcell_values[loadcell_dut_ch]))
+    # The tare in kg, so converting a value is a single multiply and subtract.
+    tare_ref_scaled = tare_ref * loadcell_ref_scale
 
-    def convert_ref(value: float) -> float:
-        """Convert reference value to weight"""
-        return (value - tare_ref) * loadcell_ref_scale
+    def convert_ref(values: np.ndarray) -> np.ndarray:
+        """Convert reference values to weight, all at once"""
+        return values * loadcell_ref_scale - tare_ref_scaled
 
     def get_ref_load() -> float:
         """Gets the latest reference loadcell value and converts to kg"""
-        return convert_ref(loadcell_values[loadcell_ref_ch][-1])
+        # Same as convert_ref, inlined since it runs on every new sample.
+        return ref_buffer.last() * loadcell_ref_scale - tare_ref_scaled
 
-    print("tare * scale", tare_ref * loadcell_ref_scale, "kg")
+    log.info("tare * scale %s kg", tare_ref_scaled)
 
     ## Assume positive is compression
     # TODO - should just take the absolute value instead
@@ -151,53 +303,49 @@ def generate_calibration_curve(
     # To generate the curve, push the loadcell to the test load, and then back
     # off slowly. The data from backing off should be used for
 
-    print("recording the values")
-
-    # clear the value
-    loadcell_values = {loadcell_ref_ch: [], loadcell_dut_ch: []}
+    log.info("recording the values")
 
-    # Start recodring both loadcells
-    ch_ref.setOnVoltageRatioChangeHandler(save_bridge_value)
-    ch_dut.setOnVoltageRatioChangeHandler(save_bridge_value)
-
-    # Wait for the phidgets to start recording
-    while len(loadcell_values[loadcell_ref_ch]) == 0:
-        time.sleep(loadcell_sample_interval / 1000)
+    # Wait for the first recorded value
+    while ref_buffer.count == 0:
+        wait_for_values(ref_buffer, 0)
 
     # 1. Push to minimal load
     # This ensures that there is contact between the two loadcells. Allows for
     # smoother pushing.
     load_minimal = 2
 
-    print("Push to minimal load,", load_minimal)
+    log.info("Push to minimal load, %s", load_minimal)
     motor.ForwardM1(motor_addr, 40)
-    with tqdm(total=load_minimal, unit="kg") as pbar:
+    with tqdm(total=load_minimal, unit="kg", mininterval=pbar_interval) as pbar:
+        num_vals = ref_buffer.count
         while (cur_load := get_ref_load()) < load_minimal:
-            pbar.n = cur_load
-            pbar.refresh()
-            time.sleep(loadcell_sample_interval / 1000)
+            # update() skips redraws within mininterval
+            if (delta := cur_load - pbar.n) > 0.5:
+                pbar.update(delta)
+            num_vals = wait_for_values(ref_buffer, num_vals)
         # technically it could be larger, but tqdm doesn't like it
         pbar.n = load_minimal
         pbar.refresh()
     motor.ForwardM1(motor_addr, 0)
     time.sleep(0.5)  # time to slow the motor down to a stop.
-    print("Num values:", len(loadcell_values[loadcell_dut_ch]))
+    log.info("Num values: %d", dut_buffer.count)
 
     # 2. Push to test load
     # TODO this load is much lower than the maximum for two reasons:
     # - it takes time to slow down, so it overshoot by a lot
     # - the loadcell bottoms out at 150kg TODO fix this
     test_load = 120.0
-    print("Push to test load,", test_load)
+    log.info("Push to test load, %s", test_load)
     # Duty -32768 to +32767, accel: is 0 to 655359
     # TODO figure out the numbers that work
     accel_limit = int(0.01 * 655359)
     motor.DutyAccelM1(motor_addr, accel_limit, int(0.3 * 32767))
-    with tqdm(total=test_load, unit="kg") as pbar:
+    with tqdm(total=test_load, unit="kg", mininterval=pbar_interval) as pbar:
+        num_vals = ref_buffer.count
         while (cur_load := get_ref_load()) < test_load:
-            pbar.n = cur_load
-            pbar.refresh()
-            time.sleep(loadcell_sample_interval / 1000)
+            if (delta := cur_load - pbar.n) > 0.5:
+                pbar.update(delta)
+            num_vals = wait_for_values(ref_buffer, num_vals)
         pbar.n = test_load  # technically it could be larger, but tqdm doesn't like it
         pbar.refresh()
 
@@ -205,43 +353,54 @@ def generate_calibration_curve(
     # The motor can be back driven. A small duty cycle is used to try to keep
     # the motor still.
     motor.DutyAccelM1(motor_addr, accel_limit, int(0.16 * 32767))
-    print("Hangout at peak load:", get_ref_load())
+    log.info("Hangout at peak load: %s", get_ref_load())
     time.sleep(2.0)
 
     cur_load = get_ref_load()
-    print("load now at:", cur_load)
+    log.info("load now at: %s", cur_load)
 
     # 4. Reverse slowly to generate the data for the curve
     motor.DutyAccelM1(motor_addr, accel_limit, -int(0.35 * 32767))
-    print("Slowly reversing")
-    with tqdm(total=cur_load, unit="kg") as pbar:
-        while (cur_load := get_ref_load()) > load_minimal:
-            pbar.n = cur_load
-            pbar.refresh()
-            time.sleep(loadcell_sample_interval / 1000)
+    log.info("Slowly reversing")
+    with tqdm(total=cur_load, unit="kg", mininterval=pbar_interval) as pbar:
+        # Convert all the values that arrived since the last wake up at once.
+        # The lowest is checked against the minimal load, so a crossing on any
+        # of them ends the ramp, even if several arrived during a redraw.
+        num_converted = ref_buffer.count
+        pbar_time = time.monotonic()
+        while cur_load > load_minimal:
+            # tqdm only throttles increasing progress, so do it by hand here.
+            if (now := time.monotonic()) - pbar_time > pbar_interval:
+                pbar.n = max(0, cur_load)
+                pbar.refresh()
+                pbar_time = now
+            num_vals = wait_for_values(ref_buffer, num_converted)
+            loads = convert_ref(ref_buffer.between(num_converted, num_vals))
+            num_converted = num_vals
+            cur_load = loads.min()
         pbar.n = cur_load
         pbar.refresh()
 
-    print("Num values:", len(loadcell_values[loadcell_dut_ch]))
+    log.info("Num values: %d", dut_buffer.count)
+    ref_loads = convert_ref(ref_buffer.values())
+    log.info("Peak recorded load: %s kg", ref_loads.max())
 
     # 5. Move back quickly to reset
-    print("moving back for one second")
+    log.info("moving back for one second")
     motor.BackwardM1(motor_addr, 127)
     time.sleep(1)
     motor.BackwardM1(motor_addr, 0)
 
-    # print(loadcell_values)
+    # print(ref_buffer.values(), dut_buffer.values())
     # print(sample_count_at_peak)
-    return loadcell_values[loadcell_ref_ch], loadcell_values[loadcell_dut_ch]
+    return ref_buffer.values(), dut_buffer.values(), tare_ref, tare_dut
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
     # A bunch of hard coded variables for now
-    # The motor controller shows up as stm virtual com port.
-    # pick the first match.
-    MOTOR_COM = next(
-        serial.tools.list_ports.grep("STMicroelectronics Virtual COM Port")
-    ).device
+    MOTOR_COM = find_motor_com()
     MOTOR_BAUD = 115200  # This preconfigured for the controller
     MOTOR_ADDR = 0x80  # This is preconfigured
     # The motor controller library kinda sucks cause it needs the address passed
@@ -254,12 +413,26 @@ if __name__ == "__main__":
 
     LOADCELL_REF_CH = 3  # Wired in the 3rd channel
 
+    dir_data = Path("../loadcell_calibration_data/data/")
+    dir_data.mkdir(parents=True, exist_ok=True)
+    # Adhoc csv file, TODO make this nicer
+    # Opened once up front, line buffered so each calibration is written out
+    # as soon as it is logged.
+    file_cal_logs = dir_data / "calibration_logs.csv"
+    cal_logs = open(file_cal_logs, mode="a", buffering=1)
+    atexit.register(cal_logs.close)
+
     LOADCELL_DUT_CH = int(input("Loadcell dut channel: "))
     # TODO add logging to the save directory
 
     loadcell_dut_serial = input("Serial no of DUT: ")
 
-    loadcell_values_ref, loadcell_values_dut = generate_calibration_curve(
+    (
+        loadcell_values_ref,
+        loadcell_values_dut,
+        tare_ref,
+        tare_dut,
+    ) = generate_calibration_curve(
         MOTOR_COM,
         MOTOR_BAUD,
         MOTOR_ADDR,
@@ -268,6 +441,11 @@ if __name__ == "__main__":
         LOADCELL_DUT_CH,
     )
 
+    # Float32 is plenty for the bridge resolution. Convert once here, so the
+    # curve is parsed from exactly the values that get saved.
+    loadcell_values_ref = np.asarray(loadcell_values_ref, dtype=np.float32)
+    loadcell_values_dut = np.asarray(loadcell_values_dut, dtype=np.float32)
+
     scale_dut, resid = parse_calibration_curve(
         loadcell_values_ref, loadcell_values_dut, LOADCELL_REF_SCALE
     )
@@ -275,23 +453,29 @@ if __name__ == "__main__":
     # TODO Save loadcell values somewhere
     # save 5 values - the 3 inputs to the function (to reporduce) and the output
     date_str = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
-    dir_data = Path("../loadcell_calibration_data/data/")
     dir_cal = dir_data / loadcell_dut_serial / date_str
-    print("Saving calibration curves to:", dir_cal)
+    log.info("Saving calibration curves to: %s", dir_cal)
     dir_cal.mkdir(parents=True, exist_ok=True)
-    np.savetxt(dir_cal / "loadcell_values_ref.txt", loadcell_values_ref)
-    np.savetxt(dir_cal / "loadcell_values_dut.txt", loadcell_values_dut)
-    np.savetxt(dir_cal / "loadcell_ref_scale.txt", [LOADCELL_REF_SCALE])
-
-    file_cal_logs = dir_data / "calibration_logs.csv"
-    file_cal_logs.touch(exist_ok=True)
-    print("Writing calivration data to log:", file_cal_logs)
-    # Adhoc csv file, TODO make this nicer
-    with open(file_cal_logs, mode="a") as f:
-        line = ", ".join((date_str, loadcell_dut_serial, str(scale_dut), str(resid)))
-        print(line, file=f)
-        # f.write(line)
-        # f.write("\n")
+    # Everything needed to reproduce the calibration in one file.
+    np.savez_compressed(
+        dir_cal / "calibration.npz",
+        ref=loadcell_values_ref,
+        dut=loadcell_values_dut,
+        scale=LOADCELL_REF_SCALE,
+    )
+    # Small human readable summary
+    with open(dir_cal / "calibration.json", mode="w") as f:
+        summary = {
+            "loadcell_ref_scale": LOADCELL_REF_SCALE,
+            "scale_dut": float(scale_dut),
+            "resid": float(resid),
+            "tare_ref": tare_ref,
+            "tare_dut": tare_dut,
+        }
+        json.dump(summary, f, indent=4)
+
+    log.info("Writing calivration data to log: %s", file_cal_logs)
+    cal_logs.write(f"{date_str}, {loadcell_dut_serial}, {scale_dut}, {resid}\n")
 
     # Note: the mavin loadcell should be 2 mV / V for 200kg, which works out to
     # a scale of 200 kg / 2mV/V = 100 kg / mv/V or 100'000 kg / V/V
@@ -15,48 +15,78 @@ import argparse
 
 import numpy as np
 import matplotlib.pyplot as plt
-from scipy.interpolate import CubicSpline
 
 
-def interpolate_2x(vals):
-    """Cubic interpolation in between each value"""
-    xp = np.arange(0, len(vals), 1)  # indexes
-    x = np.arange(0, len(vals) - 0.5, 0.5)  # half step indexes
-    assert len(xp) * 2 - 1 == len(x)
-
-    # There are some peak loads when the motor stops, so a cubic spline fits
-    # better than just linear interpolation. And the acceleration is smoother.
-    vals_spline = CubicSpline(xp, vals)
-
-    # vals_linear = np.interp(x, xp, vals)
-
-    # plt.plot(x, vals_linear, label="linear")
-    # plt.plot(x, vals_spline(x), label="cubic")
-    # plt.plot(xp, vals, 'o', label='data')
+def interpolate_2x(vals, out=None):
+    """Cubic interpolation in between each value, optionally written into out"""
+    assert len(vals) >= 4
+    if out is None:
+        out = np.empty(2 * len(vals) - 1)
+    assert len(out) == 2 * len(vals) - 1
+    out[0::2] = vals
+
+    # There are some peak loads when the motor stops, so a cubic fits better
+    # than just linear interpolation. And the acceleration is smoother.
+    # The values are evenly spaced, so the cubic through the 4 neighbouring
+    # values at each half step is a fixed weighted sum of them.
+    out[3:-3:2] = (9 * (vals[1:-2] + vals[2:-1]) - (vals[:-3] + vals[3:])) / 16
+    # The ends only have 3 neighbours, use the quadratic through them.
+    out[1] = (3 * vals[0] + 6 * vals[1] - vals[2]) / 8
+    out[-2] = (3 * vals[-1] + 6 * vals[-2] - vals[-3]) / 8
+
+    # x = np.arange(0, len(vals) - 0.5, 0.5)  # half step indexes
+    # plt.plot(x, np.interp(x, x[0::2], vals), label="linear")
+    # plt.plot(x, out, label="cubic")
+    # plt.plot(x[0::2], vals, 'o', label='data')
     # plt.legend(loc='best')
     # plt.show()
-    return vals_spline(x)
-
-
-def line_fit_residual(x, y):
-    """Calculate how close the points fit to a line"""
-    assert len(x) == len(y)
-    assert x.ndim == 1
-    assert y.ndim == 1
-    # lol, this is the new np.polyfit
-    _, (resid, _, _, _) = np.polynomial.polynomial.Polynomial.fit(x, y, 1, full=True)
-    return resid[0]
+    return out
+
+
+def line_fit(x, y):
+    """Least squares line through the points: slope, offset, residual
+
+    With 2d x and y, each row is fit separately in one pass.
+    """
+    assert x.shape == y.shape
+    assert x.ndim in (1, 2)
+    # Closed form for a line, no need for the general np.polynomial machinery.
+    # Centering first keeps the sums from losing precision, the values all
+    # have a similar offset.
+    x_mean = x.mean(axis=-1)
+    y_mean = y.mean(axis=-1)
+    dx = x - x_mean[..., np.newaxis]
+    dy = y - y_mean[..., np.newaxis]
+    slope = np.einsum("...i,...i->...", dx, dy) / np.einsum("...i,...i->...", dx, dx)
+    offset = y_mean - slope * x_mean
+    error = dy - slope[..., np.newaxis] * dx
+    return slope, offset, np.einsum("...i,...i->...", error, error)
+
+
+def load_calibration_data(dir_calibration: Path):
+    """Read the loadcell values and reference scale saved by a calibration"""
+    file_calibration = dir_calibration / "calibration.npz"
+    if not file_calibration.exists():
+        # Older calibrations were saved as text
+        values_ref = np.loadtxt(dir_calibration / "loadcell_values_ref.txt")
+        values_dut = np.loadtxt(dir_calibration / "loadcell_values_dut.txt")
+        scale_ref = np.loadtxt(dir_calibration / "loadcell_ref_scale.txt")
+        return values_ref, values_dut, float(scale_ref)
+
+    with np.load(file_calibration) as data:
+        return data["ref"], data["dut"], float(data["scale"])
 
 
 def parse_calibration_curve(
-    values_ref: list[float], values_dut: list[float], scale_ref: float, to_plot=False
+    values_ref: np.ndarray, values_dut: np.ndarray, scale_ref: float, to_plot=False
 ):
     # Tare isn't needed - curve fitting a line with offset is more accurate.
     # Its only needed if you are just looking at the ratio of the two inputs.
     # TODO - figure out if the tare is really needed, or if you should just
     # curve fit a line with an offset
-    values_ref = np.array(values_ref)
-    values_dut = np.array(values_dut)
+    # No copy if they are already contiguous arrays.
+    values_ref = np.ascontiguousarray(values_ref)
+    values_dut = np.ascontiguousarray(values_dut)
 
     # The ADC muxes between the 2 values. So they are offest by half a sample.
     # Also, the sampling could have started and stopped on either channel.
@@ -71,8 +101,12 @@ def parse_calibration_curve(
     # This assumes the testing data has both increasing and decreasing values.
     # Since that will produce a shift in both directions.
 
-    interp_ref = interpolate_2x(values_ref)
-    interp_dut = interpolate_2x(values_dut)
+    # One allocation for both channels
+    len_ref = 2 * len(values_ref) - 1
+    len_dut = 2 * len(values_dut) - 1
+    interp = np.empty((2, max(len_ref, len_dut)))
+    interp_ref = interpolate_2x(values_ref, interp[0, :len_ref])
+    interp_dut = interpolate_2x(values_dut, interp[1, :len_dut])
 
     # The shift should make the plot of ref vs dut be a line. When it isn't
     # there will be a shift in both directions from this line.
@@ -80,27 +114,29 @@ def parse_calibration_curve(
     slice_shift_back = slice(1, min_len)
     slice_no_shift = slice(0, min_len - 1)
 
-    cut_dut, cut_ref = min(
-        (interp_dut[slice_shift_back], interp_ref[slice_no_shift]),  # DUT first
-        (interp_dut[slice_no_shift], interp_ref[slice_shift_back]),  # REF first
-        key=lambda x: line_fit_residual(*x),
-    )
+    # Both shifts are fit together, one per row. DUT first, then REF first.
+    shifted_dut = np.stack((interp_dut[slice_shift_back], interp_dut[slice_no_shift]))
+    shifted_ref = np.stack((interp_ref[slice_no_shift], interp_ref[slice_shift_back]))
+    best_shift = np.argmin(line_fit(shifted_dut, shifted_ref)[2])
+    cut_dut = shifted_dut[best_shift]
+    cut_ref = shifted_ref[best_shift]
 
     if to_plot:
         plt.plot(cut_dut)
         plt.plot(cut_ref)
         plt.show()
 
-        vel_dut = np.gradient(cut_dut)
-        vel_ref = np.gradient(cut_ref)
-        accel_dut = np.gradient(vel_dut)
-        accel_ref = np.gradient(vel_ref)
+        # Second difference in one pass, instead of the gradient of the gradient
+        accel_dut = cut_dut[2:] - 2 * cut_dut[1:-1] + cut_dut[:-2]
+        accel_ref = cut_ref[2:] - 2 * cut_ref[1:-1] + cut_ref[:-2]
+        # Centered on the middle value, line up with the plots above
+        x_accel = np.arange(1, len(cut_dut) - 1)
 
-        plt.plot(accel_dut)
-        plt.plot(accel_ref)
+        plt.plot(x_accel, accel_dut)
+        plt.plot(x_accel, accel_ref)
         plt.show()
 
-        plt.scatter(np.diff(cut_dut, n=2), np.diff(cut_ref, n=2))
+        plt.scatter(accel_dut, accel_ref)
         plt.show()
 
     ref_val_max = np.max(cut_ref)
@@ -111,9 +147,13 @@ def parse_calibration_curve(
     # should cut out all load that doesn't use smooth moving.
     # TODO see if this can be hardcoded even less
     min_load_fraction = 0.1
-    start, end = np.where(cut_ref > min_load_fraction * ref_val_delta + ref_val_min)[0][
-        [0, -1]
-    ]
+    above_min_load = cut_ref > min_load_fraction * ref_val_delta + ref_val_min
+    if not above_min_load.any():
+        # argmax would return 0 and fit the whole trace
+        raise ValueError("REF load never rises above the minimal load")
+    # First and last index above the minimal load, without listing all of them.
+    start = int(np.argmax(above_min_load))
+    end = len(above_min_load) - 1 - int(np.argmax(above_min_load[::-1]))
     print(100 * min_load_fraction, "% load starts, end", start, end)
     slice_to_fit = slice(start, end)
 
@@ -122,34 +162,31 @@ def parse_calibration_curve(
     # scale_ref * value_ref/ value_dut = scale_dut
 
     print("fitline")
-    fit_line, (resid, _, _, _) = np.polynomial.polynomial.Polynomial.fit(
-        cut_dut[slice_to_fit], cut_ref[slice_to_fit], 1, full=True
-    )
-    fit_coef = fit_line.convert().coef
-
-    fit_ref = fit_line(cut_dut)
-    error = fit_ref - cut_ref
-
-    print("Error in the fit region, min, max:")
-    print(np.min(error[slice_to_fit]))
-    print(np.max(error[slice_to_fit]))
+    slope, offset, resid = line_fit(cut_dut[slice_to_fit], cut_ref[slice_to_fit])
 
     # figure out where the error is coming from
+    # Only needed for the plots, skip it when parsing right after a calibration.
     if to_plot:
+        fit_ref = slope * cut_dut + offset
+        error = fit_ref - cut_ref
+
+        print("Error in the fit region, min, max:")
+        print(np.min(error[slice_to_fit]))
+        print(np.max(error[slice_to_fit]))
 
         plt.plot(cut_ref)
         plt.plot(cut_dut)
         plt.plot(error * 1000)
         plt.show()
 
-    scale_dut = fit_coef[1] * scale_ref
+    scale_dut = slope * scale_ref
     print("scale", scale_dut)
     print("error from  spec:", (1 - scale_dut / 100000) * 100, "%")
     print("error at 200kg (if using 2mv/V):", 200 - scale_dut * 0.002)
-    print("offset", fit_coef[0])
-    print("residual", resid[0])
+    print("offset", offset)
+    print("residual", resid)
 
-    return scale_dut, resid[0]
+    return scale_dut, resid
 
 
 if __name__ == "__main__":
@@ -164,10 +201,6 @@ if __name__ == "__main__":
     dir_calibration = args.calibration_data_path
 
     # Read the 3 inputs needed
-    values_ref = np.loadtxt(dir_calibration / "loadcell_values_ref.txt")
-    values_dut = np.loadtxt(dir_calibration / "loadcell_values_dut.txt")
-    loadcell_ref_scale = np.loadtxt(dir_calibration / "loadcell_ref_scale.txt")
+    values_ref, values_dut, loadcell_ref_scale = load_calibration_data(dir_calibration)
 
-    parse_calibration_curve(
-        values_ref, values_dut, float(loadcell_ref_scale), to_plot=True
-    )
+    parse_calibration_curve(values_ref, values_dut, loadcell_ref_scale, to_plot=True)